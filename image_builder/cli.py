@@ -1,33 +1,108 @@
 import argparse
-import glob
 import logging
 import os
-from hashlib import sha256
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 
+from blake3 import blake3
 from image_builder.config import config
 from image_builder.docker import (
     docker,
     docker_silent,
     Dockerfile,
-    enter_build_context,
     get_image_digest,
+    image_exists,
+    image_exists_local,
+    locate_build_context,
     locate_dockerfile,
     parse_docker_image_identity,
     parse_dockerignore,
+    push_image,
+    registry_retag,
+    tag_image,
 )
-from image_builder.libs.utils import expand_path, get_datetime
+from image_builder.libs.utils import expand_path, get_datetime, iter_files
 
 logger = logging.getLogger(__name__)
 hash_logger = logging.getLogger("files_hash")
 hash_logger.propagate = False
 
 
-def _tag_to_extra_tags(args, image, tag):
+def _hash_file(f):
+    """return blake3 digest of the file content, or None if it is gone.
+    iter_files only yields regular files, the stat here is just for the cache key.
+    """
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return _hash_file_content(f, st.st_mtime_ns, st.st_size)
+
+
+# Images sharing a build context often copy the same files, so read each file once per run
+@lru_cache(maxsize=None)
+def _hash_file_content(f, mtime_ns, size):
+    """mtime_ns and size are part of the cache key, so a modified file gets hashed again"""
+    # blake3 memory-maps large files and hashes them with multiple threads
+    hasher = blake3(max_threads=blake3.AUTO)
+    hasher.update_mmap(f)
+    return hasher.digest()
+
+
+def _collect_files(dockerfile_path, srcs, build_context, dockerignore):
+    r"""Collect the Dockerfile and files matched by COPY/ADD srcs, return sorted absolute paths.
+    Files ignored by .dockerignore are skipped, but docker always sends the Dockerfile,
+    so it is always collected.
+
+    >>> import tempfile
+    >>> from image_builder.docker import parse_dockerignore
+    >>> d = tempfile.mkdtemp()
+    >>> for name in ("Dockerfile", "a.txt", "b.txt"):
+    ...     open(os.path.join(d, name), "w").close()
+    >>> with open(os.path.join(d, ".dockerignore"), "w") as f:
+    ...     _ = f.write("*\n!a.txt\n")
+    >>> srcs = [os.path.join(d, "."), os.path.join(d, "a.txt")]
+    >>> files = _collect_files(
+    ...     os.path.join(d, "Dockerfile"), srcs, d, parse_dockerignore(d)
+    ... )
+    >>> [os.path.relpath(f, d) for f in files]
+    ['Dockerfile', 'a.txt']
+    >>> import shutil; shutil.rmtree(d)
+    """
+    # COPY sources may overlap, so collect files in a set to hash each of them once
+    files = {os.path.abspath(dockerfile_path)}
+    # TODO: if the src is a url, download it and hash it (even crane didn't do that)
+    for src in srcs:
+        # We match every file in a directory recursively
+        for f in iter_files(src):
+            f = os.path.abspath(f)
+            # .dockerignore only applies to files in build context
+            rel_f = os.path.relpath(f, build_context)
+            in_context = not rel_f.startswith(os.pardir + os.sep)
+            if in_context and dockerignore.match_file(rel_f):
+                hash_logger.debug("ignore: %s", f)
+                continue
+            files.add(f)
+    return sorted(files)
+
+
+def _tag_to_extra_tags(args, image, tag, pull=False):
+    if not args.extra_tag and not args.extra_name:
+        return
+    # Tagging works on local images, so pull it if we only checked it in registry
+    if (
+        pull
+        and not image_exists_local(f"{image}:{tag}")
+        and docker_silent.pull(f"{image}:{tag}").returncode != 0
+    ):
+        logger.error(f"Failed to pull image {image}:{tag} for tagging extra tags")
+        return
     for extra_tag in args.extra_tag:
-        if docker.tag(f"{image}:{tag}", f"{image}:{extra_tag}").returncode != 0:
+        if tag_image(f"{image}:{tag}", f"{image}:{extra_tag}") != 0:
             logger.error(f"Failed to tag image {image} to {extra_tag}")
     for extra_name in args.extra_name:
-        if docker.tag(f"{image}:{tag}", f"{extra_name}").returncode != 0:
+        if tag_image(f"{image}:{tag}", f"{extra_name}") != 0:
             logger.error(f"Failed to tag image {image} to {extra_name}")
 
 
@@ -38,7 +113,36 @@ def build_with_cache(args):
     build_arg["GIT_SHA"] = args.git_sha
     build_arg["IMAGE_TAG"] = args.git_sha_tag
 
-    def _build(registry, image_name, git_sha):
+    # Shared ancestors in the image hierarchy only need to be resolved once per invocation.
+    # Parents are built concurrently, so later callers wait on the first caller's future.
+    built = {}
+    built_lock = threading.Lock()
+
+    def _build(registry, image_name, git_sha, ancestors=()):
+        key = (registry, image_name, git_sha)
+        # Waiting on an ancestor's future would block forever, so fail on cycles instead
+        if key in ancestors:
+            chain = " -> ".join(f"{r}/{n}:{t}" for r, n, t in ancestors + (key,))
+            raise Exception(f"Circular parent images: {chain}")
+        with built_lock:
+            future = built.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = built[key] = Future()
+        if is_owner:
+            try:
+                future.set_result(
+                    _build_image(registry, image_name, git_sha, ancestors + (key,))
+                )
+            # Resolve the future on any exception, or threads waiting on it block forever
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    def _build_parent(parent_image, ancestors):
+        return _build(*parse_docker_image_identity(parent_image), ancestors)
+
+    def _build_image(registry, image_name, git_sha, ancestors):
         """build image and all its parents if needed, and return image digest.
         Use all parents digests and current image copied files to calculate hash and cache(tag) it to registry.
         """
@@ -51,32 +155,29 @@ def build_with_cache(args):
 
         # If image:{git_sha} already exists, then return.
         logger.info(
-            f"Pulling git_sha tag {image}:{git_sha} to check if it already exists"
+            f"Checking git_sha tag {image}:{git_sha} in registry to see if it already exists"
         )
-        if (
-            not args.dry_run
-            and docker_silent.pull(f"{image}:{git_sha}").returncode == 0
-        ):
-            # better to find the hash-{hash} of this image, and return hash
+        digest = None if args.dry_run else image_exists(f"{image}:{git_sha}")
+        if digest is not None:
+            # better to find the b3-{hash} of this image, and return hash
             # but currently, it is not easy to find all tags of the same image digest through registry API.
             # so we return image digest instead.
-            digest = get_image_digest(f"{image}:{git_sha}")
             logger.info(
                 f"git_sha tag {image}:{git_sha} already exists, digest: %s", digest
             )
             if not digest:
                 raise Exception("Failed to get digest for existing image")
-            _tag_to_extra_tags(args, image, git_sha)
+            _tag_to_extra_tags(args, image, git_sha, pull=True)
             return digest
 
-        # Enter build context directory if it is specified
-        build_context = enter_build_context(image_name)
+        # Locate build context directory if it is specified
+        build_context = locate_build_context(image_name)
 
         # Parse .dockerignore in build context
-        dockerignore_files_set = parse_dockerignore(build_context)
+        dockerignore = parse_dockerignore(build_context)
 
-        # Check if the dockerfile exists
-        dockerfile_path = locate_dockerfile(image_name)
+        # Check if the dockerfile exists, relative path is inside the build context
+        dockerfile_path = os.path.join(build_context, locate_dockerfile(image_name))
         if not os.path.isfile(dockerfile_path):
             logger.error(
                 "%s not exists or is not a file, so %s cannot get build",
@@ -87,18 +188,22 @@ def build_with_cache(args):
 
         dockerfile = Dockerfile(dockerfile_path, build_arg=build_arg)
 
-        hasher = sha256()
-
-        # Build parents, and calc parents hash
-        for parent_image in dockerfile.parent_images:
-            (
-                parent_image_registry,
-                parent_image_name,
-                parent_image_tag,
-            ) = parse_docker_image_identity(parent_image)
-            parent_digest = _build(
-                parent_image_registry, parent_image_name, parent_image_tag
-            )
+        hasher = blake3()
+
+        # Build parents concurrently, and calc parents hash in the original order
+        parent_images = dockerfile.parent_images
+        parent_digests = []
+        if parent_images:
+            max_workers = min(int(config.MAX_BUILD_WORKERS), len(parent_images))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                parent_digests = list(
+                    executor.map(
+                        _build_parent,
+                        parent_images,
+                        [ancestors] * len(parent_images),
+                    )
+                )
+        for parent_image, parent_digest in zip(parent_images, parent_digests):
             if parent_digest is None:
                 raise Exception(f"Failed to get parent_digest for {image}")
             hasher.update(parent_digest.encode())
@@ -111,63 +216,51 @@ def build_with_cache(args):
             )
 
         # Calc current image files hash
-
-        def update_file_hash(f):
-            if not os.path.isfile(f):
-                return
-            if f in dockerignore_files_set:
-                hash_logger.debug("ignore: %s", f)
-                return
-            with open(f, "rb") as open_file:
-                buf = open_file.read(config.READ_FILE_BLOCKSIZE)
-                while len(buf) > 0:
-                    hasher.update(buf)
-                    buf = open_file.read(config.READ_FILE_BLOCKSIZE)
-            hash_logger.info("update: %s, hash: %s", f, hasher.hexdigest())
-
-        srcs = [dockerfile_path] + dockerfile.copied_srcs + dockerfile.added_srcs
-        # TODO: if the src is a url, download it and hash it (even crane didn't do that)
-        for src in srcs:
-            for f in sorted(glob.glob(src)):
-                # We match every file in a directory recursively
-                if os.path.isdir(f):
-                    for sub_f in sorted(glob.glob(f"{f}/**", recursive=True)):
-                        update_file_hash(sub_f)
-                else:
-                    update_file_hash(f)
+        srcs = [
+            os.path.join(build_context, src)
+            for src in dockerfile.copied_srcs + dockerfile.added_srcs
+        ]
+        files = _collect_files(dockerfile_path, srcs, build_context, dockerignore)
+        # Files are hashed concurrently, then merged by path order with their relative paths
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for f, file_digest in zip(files, executor.map(_hash_file, files)):
+                if file_digest is None:
+                    continue
+                hasher.update(os.path.relpath(f, build_context).encode())
+                hasher.update(file_digest)
+                hash_logger.info("update: %s, hash: %s", f, hasher.hexdigest())
 
         files_hash = hasher.hexdigest()
         hash_logger.info("image: %s, hash: %s", image, files_hash)
 
         hash_tag = config.FILES_HASH_TAG_PATTERN.format(files_hash=files_hash)
-        # FIXME(harry): hack, remove this
-        old_hash_image = f"docker-registry.example.com:5000/{image_name}:{hash_tag}"
 
         logger.info(
-            f"Pulling files_hash tag {image}:{hash_tag} to check if it already exists"
+            f"Checking files_hash tag {image}:{hash_tag} in registry to see if it already exists"
         )
-        # If image:hash-{hash} already exists,
+        # If image:b3-{hash} already exists,
         # then content didn't change, return.
         # We just need to tag it to latest code version.
-        if (
-            not args.dry_run
-            and docker_silent.pull(f"{image}:{hash_tag}").returncode == 0
-        ):
+        if not args.dry_run and image_exists(f"{image}:{hash_tag}") is not None:
             logger.info(
                 f"files_hash tag {image}:{hash_tag} already exists, "
                 "it means content didn't change, we can just tag the old image to new git_sha version tag"
             )
-        # FIXME(harry): hack, remove this
-        elif not args.dry_run and docker_silent.pull(old_hash_image).returncode == 0:
-            logger.info(f"NOTE: files_hash tag {old_hash_image} already exists!")
-            # tag and push this hash image
-            if docker.tag(old_hash_image, f"{image}:{hash_tag}").returncode != 0:
-                logger.error("Failed to tag old hash image")
-                return
-            if docker.push(f"{image}:{hash_tag}").returncode != 0:
-                logger.error("Failed to push hash_tag image")
+            digest = registry_retag(image, hash_tag, git_sha)
+            if digest:
+                logger.info(
+                    f"image {image}:{hash_tag} is tagged to {git_sha} in registry, digest: {digest}"
+                )
+                _tag_to_extra_tags(args, image, git_sha, pull=True)
+                return digest
+            # Registry doesn't support putting manifest, tag and push it locally instead
+            if (
+                not image_exists_local(f"{image}:{hash_tag}")
+                and docker_silent.pull(f"{image}:{hash_tag}").returncode != 0
+            ):
+                logger.error("Failed to pull hash_tag image")
                 return
-        # If image:hash-{hash} not exists, then build it from Dockerfile.
+        # If image:b3-{hash} not exists, then build it from Dockerfile.
         else:
             logger.info(
                 f"files_hash tag {image}:{hash_tag} dosen't exists, "
@@ -176,17 +269,17 @@ def build_with_cache(args):
             if build_with_raw_command(args, image, dockerfile_path, hash_tag) != 0:
                 logger.error(f"Failed to build {image}:{hash_tag}")
                 return
-            if docker.push(f"{image}:{hash_tag}").returncode != 0:
+            if push_image(f"{image}:{hash_tag}") != 0:
                 logger.error(f"Failed to push image")
                 return
             logger.info(f"image files_hash tag {image}:{hash_tag} is pushed")
 
         # tag and push this final image
-        if docker.tag(f"{image}:{hash_tag}", f"{image}:{git_sha}").returncode != 0:
+        if tag_image(f"{image}:{hash_tag}", f"{image}:{git_sha}") != 0:
             logger.error("Failed to tag image")
             return
         _tag_to_extra_tags(args, image, git_sha)
-        if docker.push(f"{image}:{git_sha}").returncode != 0:
+        if push_image(f"{image}:{git_sha}") != 0:
             logger.error("Failed to push image")
             return
         digest = get_image_digest(f"{image}:{git_sha}")
@@ -7,10 +7,11 @@ DOCKERFILE_PATH_PATTERN = os.path.join(
     os.path.dirname(PROJECT_ROOT), "images/{image_name}/Dockerfile"
 )
 
-FILES_HASH_TAG_PATTERN = "hash-{files_hash}"
+FILES_HASH_TAG_PATTERN = "b3-{files_hash}"
 GIT_SHA_TAG_PATTERN = "{git_sha}-untested"
 
-READ_FILE_BLOCKSIZE = 65536
+# Max number of parent images to build concurrently
+MAX_BUILD_WORKERS = 8
 
 DOCKER_REGISTRY_IMAGE_API = "https://{registry}/v2/{image_name}/manifests/{image_tag}"
 
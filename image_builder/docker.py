@@ -1,22 +1,63 @@
-import glob
 import logging
-import operator
 import os
+import posixpath
+import re
 import sys
-from functools import reduce
+from functools import lru_cache
 
+import docker as docker_sdk
+import pathspec
 import requests
 from dockerfile_parse import DockerfileParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from image_builder.config import config
-from image_builder.libs.process import Process, process
+from image_builder.libs.process import Process
+from image_builder.libs.utils import cached_property
 
 logger = logging.getLogger(__name__)
 
 docker = Process(stdout=sys.stdout, stderr=sys.stderr).docker
-docker_silent = process.docker
+docker_silent = Process(silent=True).docker
+
+# Reuse connections to registry, instead of a new TCP+TLS handshake per request
+_session = requests.Session()
+_session.verify = False
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    ),
+)
+
+
+# ${ARG} or $ARG
+ARG_PATTERN = re.compile(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)")
 
 
 class Dockerfile(DockerfileParser):
+    r"""DockerfileParser with build args substituted, ${ARG} and $ARG alike.
+    Variables which aren't build args are left as they are.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> with open(os.path.join(d, "Dockerfile"), "w") as f:
+    ...     _ = f.write("ARG SRC=app\n")
+    ...     _ = f.write("FROM $REGISTRY/base:${IMAGE_TAG}\n")
+    ...     _ = f.write("COPY ${SRC}/a $HOME/a\n")
+    ...     _ = f.write("ADD $SRC_DIR ${UNKNOWN}\n")
+    >>> dockerfile = Dockerfile(d, build_arg={"REGISTRY": "r:5000", "IMAGE_TAG": "v1"})
+    >>> dockerfile.parent_images
+    ['r:5000/base:v1']
+    >>> dockerfile.copys
+    ['app/a $HOME/a']
+    >>> dockerfile.adds
+    ['$SRC_DIR ${UNKNOWN}']
+    >>> import shutil; shutil.rmtree(d)
+    """
+
     def __init__(self, path, build_arg=None):
         # FIXME: use build_arg instead of parent_env
         super().__init__(path, parent_env=build_arg)
@@ -34,6 +75,24 @@ class Dockerfile(DockerfileParser):
         self.build_arg = default_args
         logger.debug("computed build_arg: %s", self.build_arg)
         self.arg_replace = True
+        # values parsed before replacing args are stale now
+        self.__dict__.pop("values_by_instruction", None)
+
+    def _replace_arg(self, match):
+        arg = match.group(1) or match.group(2)
+        return self.build_arg.get(arg, match.group(0))
+
+    @cached_property
+    def _raw_lines(self):
+        """lines read from Dockerfile, read only once however many times it is parsed"""
+        from dockerfile_parse.parser import b2u
+
+        try:
+            with self._open_dockerfile("rb") as dockerfile:
+                return [b2u(l) for l in dockerfile.readlines()]
+        except (IOError, OSError) as ex:
+            logger.error("Couldn't retrieve lines from dockerfile: %r", ex)
+            raise
 
     # FIXME: support ARG expansion in dockerfile_parse, then remove those hacks
     @property
@@ -41,43 +100,20 @@ class Dockerfile(DockerfileParser):
         """
         :return: list containing lines (unicode) from Dockerfile
         """
-        from dockerfile_parse.parser import b2u
-
         if self.cache_content and self.cached_content:
             return self.cached_content.splitlines(True)
 
-        try:
-            with self._open_dockerfile("rb") as dockerfile:
-                lines = [b2u(l) for l in dockerfile.readlines()]
-
-                # HACK:
-                if self.arg_replace:
-                    # lambda produce something like ('${REGISTRY}', 'docker-registry.example.com:5000')
-                    f1 = lambda arg: (
-                        f"${{{arg}}}",
-                        self.build_arg.get(arg, f"${{{arg}}}"),
-                    )
-                    f2 = lambda arg: (f"${arg}", self.build_arg.get(arg, f"${arg}"))
-                    lines = [
-                        l.replace(*f1("REGISTRY"))
-                        .replace(*f2("REGISTRY"))
-                        .replace(*f1("GIT_SHA"))
-                        .replace(*f2("GIT_SHA"))
-                        .replace(*f1("IMAGE_TAG"))
-                        .replace(*f2("IMAGE_TAG"))
-                        .replace(*f1("APP_DIR"))
-                        .replace(*f2("APP_DIR"))
-                        for l in lines
-                    ]
-
-                if self.cache_content:
-                    self.cached_content = "".join(lines)
-                return lines
-        except (IOError, OSError) as ex:
-            logger.error("Couldn't retrieve lines from dockerfile: %r", ex)
-            raise
+        # HACK:
+        if self.arg_replace:
+            lines = [ARG_PATTERN.sub(self._replace_arg, l) for l in self._raw_lines]
+        else:
+            lines = list(self._raw_lines)
 
-    @property
+        if self.cache_content:
+            self.cached_content = "".join(lines)
+        return lines
+
+    @cached_property
     def values_by_instruction(self):
         ret = {}
         for insndesc in self.structure:
@@ -88,22 +124,22 @@ class Dockerfile(DockerfileParser):
     def get_by_instruction(self, instruction):
         return self.values_by_instruction.get(instruction, [])
 
-    @property
+    @cached_property
     def copys(self):
         # We don't care files copied from other stage
         return [
             v for v in self.get_by_instruction("COPY") if not v.startswith("--from")
         ]
 
-    @property
+    @cached_property
     def copied_srcs(self):
         return [copy.split()[0] for copy in self.copys]
 
-    @property
+    @cached_property
     def adds(self):
         return self.get_by_instruction("ADD")
 
-    @property
+    @cached_property
     def added_srcs(self):
         return [add.split()[0] for add in self.adds]
 
@@ -115,18 +151,172 @@ def parse_docker_image_identity(image):
     return registry, image_name, image_tag
 
 
-def get_image_digest(image):
+MANIFEST_V2_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+# Accept every manifest type like docker pull does, registry returns 404 for unaccepted ones
+MANIFEST_ACCEPT = ", ".join(
+    [
+        MANIFEST_V2_MEDIA_TYPE,
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json",
+    ]
+)
+
+
+def _image_manifest_url(image):
     registry, image_name, image_tag = parse_docker_image_identity(image)
-    r = requests.head(
-        config.DOCKER_REGISTRY_IMAGE_API.format(
-            registry=registry, image_name=image_name, image_tag=image_tag
-        ),
-        headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json"},
-        verify=False,
+    return config.DOCKER_REGISTRY_IMAGE_API.format(
+        registry=registry, image_name=image_name, image_tag=image_tag
+    )
+
+
+def _head_image_manifest(image):
+    return _session.head(
+        _image_manifest_url(image),
+        headers={"Accept": MANIFEST_ACCEPT},
+        timeout=5,
     )
+
+
+@lru_cache(maxsize=None)
+def get_image_digest(image):
+    return _head_image_manifest(image).headers.get("docker-content-digest", "")
+
+
+def image_exists(image):
+    """check if the image exists in registry without pulling it.
+    Return its digest ("" if the registry doesn't tell) if it exists, otherwise None.
+    """
+    try:
+        r = _head_image_manifest(image)
+    except requests.RequestException as e:
+        logger.warning("Failed to check image %s in registry: %s", image, e)
+        return None
+    if r.status_code != 200:
+        return None
     return r.headers.get("docker-content-digest", "")
 
 
+def registry_retag(image, src_tag, dst_tag):
+    """tag image:src_tag to image:dst_tag by putting its manifest under the new tag in registry,
+    without pulling or pushing any layer. Return digest of the new tag, or None on failure,
+    so callers can fall back to pull, tag and push.
+
+    >>> registry_retag("127.0.0.1:9/app", "v1", "v2") is None
+    True
+    """
+    try:
+        r = _session.get(
+            _image_manifest_url(f"{image}:{src_tag}"),
+            headers={"Accept": MANIFEST_ACCEPT},
+            timeout=5,
+        )
+        if r.status_code != 200:
+            logger.warning(
+                "Failed to get manifest of %s:%s, status: %s",
+                image,
+                src_tag,
+                r.status_code,
+            )
+            return None
+        r = _session.put(
+            _image_manifest_url(f"{image}:{dst_tag}"),
+            data=r.content,
+            headers={
+                "Content-Type": r.headers.get("Content-Type", MANIFEST_V2_MEDIA_TYPE)
+            },
+            timeout=5,
+        )
+    except requests.RequestException as e:
+        logger.warning(
+            "Failed to retag %s:%s to %s in registry: %s", image, src_tag, dst_tag, e
+        )
+        return None
+    if r.status_code != 201:
+        logger.warning(
+            "Failed to put manifest of %s:%s, status: %s", image, dst_tag, r.status_code
+        )
+        return None
+    return r.headers.get("docker-content-digest") or get_image_digest(
+        f"{image}:{dst_tag}"
+    )
+
+
+@lru_cache(maxsize=None)
+def _docker_api():
+    """low-level docker daemon API client, created on first use"""
+    return docker_sdk.from_env().api
+
+
+def _split_repository_tag(image):
+    registry, image_name, image_tag = parse_docker_image_identity(image)
+    repository = f"{registry}/{image_name}" if registry else image_name
+    return repository, image_tag
+
+
+def tag_image(image, target):
+    """tag image through docker daemon API, saving a docker CLI process.
+    Return 0 on success, like a returncode.
+    """
+    if os.environ.get("DRY_RUN"):
+        logger.info("[DRY-RUN] Tagging image %s to %s", image, target)
+        return 0
+    logger.debug("Tagging image %s to %s", image, target)
+    repository, target_tag = _split_repository_tag(target)
+    if not target_tag:
+        # docker SDK would silently tag it as latest
+        logger.error("Failed to tag image %s to %s: empty tag", image, target)
+        return 1
+    try:
+        return 0 if _docker_api().tag(image, repository, target_tag) else 1
+    except docker_sdk.errors.DockerException as e:
+        logger.error("Error occurred when tagging image %s to %s: %s", image, target, e)
+        return 1
+
+
+def image_exists_local(image):
+    """check if the image exists in local docker daemon, which is much cheaper than pulling it"""
+    if os.environ.get("DRY_RUN"):
+        return False
+    try:
+        _docker_api().inspect_image(image)
+    except docker_sdk.errors.ImageNotFound:
+        return False
+    except docker_sdk.errors.DockerException as e:
+        logger.warning("Error occurred when inspecting local image %s: %s", image, e)
+        return False
+    return True
+
+
+def push_image(image):
+    """push image through docker daemon API, saving a docker CLI process.
+    Return 0 on success, like a returncode.
+    """
+    if os.environ.get("DRY_RUN"):
+        logger.info("[DRY-RUN] Pushing image %s", image)
+        return 0
+    logger.debug("Pushing image %s", image)
+    repository, image_tag = _split_repository_tag(image)
+    if not image_tag:
+        # docker SDK would push all local tags of the repository
+        logger.error("Failed to push image %s: empty tag", image)
+        return 1
+    try:
+        for line in _docker_api().push(
+            repository, tag=image_tag, stream=True, decode=True
+        ):
+            if "error" in line:
+                logger.error(
+                    "Error occurred when pushing image %s: %s", image, line["error"]
+                )
+                return 1
+            logger.debug("push %s: %s", image, line)
+    except docker_sdk.errors.DockerException as e:
+        logger.error("Error occurred when pushing image %s: %s", image, e)
+        return 1
+    return 0
+
+
 def locate_dockerfile(image_name):
     """locate Dockerfile by environment variables or defined path pattern"""
     return os.environ.get(
@@ -135,19 +325,26 @@ def locate_dockerfile(image_name):
     )
 
 
-def enter_build_context(image_name):
-    build_context = os.environ.get(
-        config.BUILD_CONTEXT_ENV_PATTERN.format(image_name=image_name)
+def locate_build_context(image_name):
+    """locate build context by environment variables, default to current working directory.
+    We don't chdir into it, since parent images may be built concurrently.
+    """
+    return os.environ.get(
+        config.BUILD_CONTEXT_ENV_PATTERN.format(image_name=image_name), os.getcwd()
     )
-    if build_context is not None:
-        os.chdir(build_context)
-        return build_context
-    return os.getcwd()
+
+
+# pathspec 1.0 renamed "gitwildmatch" to "gitignore" and deprecated the old name,
+# while pythons < 3.9 can only install pathspec 0.x where "gitignore" is the deprecated one.
+_GITIGNORE_PATTERN = (
+    "gitignore" if int(pathspec.__version__.split(".")[0]) >= 1 else "gitwildmatch"
+)
 
 
 def parse_dockerignore(path):
-    r"""Parse .dockerignore file under the path, return files set.
+    r"""Parse .dockerignore file under the path, return a PathSpec matching paths relative to it.
     The rule based on https://docs.docker.com/engine/reference/builder/#dockerignore-file
+    Patterns are anchored to the build context root, like docker does.
 
     >>> from tempfile import NamedTemporaryFile
     >>> f = NamedTemporaryFile(delete=False)
@@ -157,9 +354,13 @@ def parse_dockerignore(path):
     >>> _ = f.write(b"!**\n")
     >>> _ = f.write(b"README*\n")
     >>> _ = f.write(b"s?tup.py\n")
+    >>> _ = f.write(b"**/*.pyc\n")
     >>> f.close()
-    >>> parse_dockerignore(f.name)
-    {'README.md', 'setup.py'}
+    >>> spec = parse_dockerignore(f.name)
+    >>> [p for p in ("Makefile", "README.md", "setup.py", "image_builder/cli.py") if spec.match_file(p)]
+    ['README.md', 'setup.py']
+    >>> spec.match_file("docs/README.md"), spec.match_file("image_builder/cli.pyc")
+    (False, True)
     >>> import os; os.unlink(f.name)
     """
     path = os.path.join(path, ".dockerignore") if os.path.isdir(path) else path
@@ -167,28 +368,26 @@ def parse_dockerignore(path):
         logger.warning(
             "failed to parse .dockerignore, %s is not a file or not exists", path
         )
-        return []
-
-    def _glob(pattern):
-        return reduce(
-            operator.add,
-            (
-                glob.glob(f"{f}/**", recursive=True) if os.path.isdir(f) else [f]
-                for f in glob.glob(pattern, recursive=True)
-            ),
-            [],
-        )
+        return pathspec.PathSpec([])
+    path = os.path.abspath(path)
+    return _parse_dockerignore(path, os.stat(path).st_mtime_ns)
+
 
-    files = set()
+@lru_cache(maxsize=64)
+def _parse_dockerignore(path, mtime_ns):
+    """mtime_ns is part of the cache key, so a modified .dockerignore gets parsed again"""
+    lines = []
     with open(path) as f:
         for line in f:
-            line = line.rstrip()
-            if line.startswith("#"):
+            line = line.strip()
+            if not line or line.startswith("#"):
                 continue
-            if line.startswith("!"):
-                files.difference_update(_glob(line[1:]))
-            files.update(_glob(line))
-    return files
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            line = "/" + posixpath.normpath(line).lstrip("/")
+            lines.append("!" + line if negate else line)
+    return pathspec.PathSpec.from_lines(_GITIGNORE_PATTERN, lines)
 
 
 if __name__ == "__main__":
@@ -37,20 +37,27 @@ import logging
 import os
 import shlex
 import subprocess
+from types import SimpleNamespace
 
 import six
 
 logger = logging.getLogger(__name__)
 
 
-def _call(cmd, env=None, nonblock=False, shell=False, stdout=None, stderr=None):
-    """if nonblock, return the process itself, otherwise return a result dict"""
+def _call(
+    cmd, env=None, nonblock=False, shell=False, stdout=None, stderr=None, silent=False
+):
+    """if nonblock, return the process itself, otherwise return a result namespace.
+    if silent, discard the output instead of capturing it.
+    """
     fullcmd = cmd if shell else " ".join(cmd)
     if os.environ.get("DRY_RUN"):
         logger.info("[DRY-RUN] Running process %s" % fullcmd)
-        return AttrDict(returncode=0)
+        return SimpleNamespace(returncode=0, stdout=None, stderr=None, fullcmd=fullcmd)
     logger.debug("Running process %s" % fullcmd)
     kw = dict(env=env) if env else {}
+    if silent:
+        stdout = stderr = subprocess.DEVNULL
     try:
         process = subprocess.Popen(
             cmd,
@@ -65,44 +72,42 @@ def _call(cmd, env=None, nonblock=False, shell=False, stdout=None, stderr=None):
         raise err
     if nonblock:
         return process
+    if silent:
+        return SimpleNamespace(
+            returncode=process.wait(),
+            stdout=None,
+            stderr=None,
+            fullcmd=fullcmd,
+        )
     out, err = process.communicate()
     out = str(out)
     err = str(err)
 
-    result = AttrDict(
+    result = SimpleNamespace(
         returncode=process.returncode,
         stdout=out,
         stderr=err,
         fullcmd=fullcmd,
-        _raise_if_attr_not_found=True,
     )
     return result
 
 
-class AttrDict(dict):
-    def __init__(self, *args, **kwargs):
-        super(AttrDict, self).__init__(*args, **kwargs)
-
-    def __getattr__(self, attr):
-        if self.get("_raise_if_attr_not_found") and attr not in self:
-            raise AttributeError(f"There's no attribute called {attr}")
-        return self.get(attr, self.get("_default_value"))
-
-    def __setattr__(self, attr, value):
-        self[attr] = value
-
-
 class Process(object):
     def __init__(self, cmds=None, **kw):
         self.cmds = cmds or []
         self.options = kw
+        self._subproc_cache = {}
 
     def __getattr__(self, name):
         # make doctest happy
         if name == "__wrapped__":
             raise AttributeError
-        name = name.replace("_", "-")  # e.g. format_patch -> format-patch
-        return self.bake(name)
+        # baked subprocesses are never mutated, calling them bakes another one
+        subproc = self._subproc_cache.get(name)
+        if subproc is None:
+            # e.g. format_patch -> format-patch
+            subproc = self._subproc_cache[name] = self.bake(name.replace("_", "-"))
+        return subproc
 
     def __call__(self, *a, **kw):
         proc = self.bake()
@@ -1,6 +1,26 @@
+import glob
 import os
+import stat
 from datetime import datetime
 
+try:
+    from functools import cached_property
+except ImportError:  # python < 3.8
+
+    class cached_property:
+        def __init__(self, func):
+            self.func = func
+            self.__doc__ = func.__doc__
+
+        def __set_name__(self, owner, name):
+            self.attrname = name
+
+        def __get__(self, instance, owner=None):
+            if instance is None:
+                return self
+            value = instance.__dict__[self.attrname] = self.func(instance)
+            return value
+
 
 def expand_path(path):
     return os.path.abspath(os.path.expanduser(path))
@@ -8,3 +28,51 @@ def expand_path(path):
 
 def get_datetime():
     return datetime.utcnow().isoformat()
+
+
+def iter_files(pattern):
+    """Yield regular files matching the glob pattern, and regular files under matched directories.
+    Like `glob.glob(f"{dir}/**")`, hidden entries under directories are skipped,
+    and paths are yielded in the same order as sorting them all.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> for name in ("a/b", "a/.hidden", "a/d/e", "a-c", "a0", ".top"):
+    ...     os.makedirs(os.path.dirname(os.path.join(d, name)), exist_ok=True)
+    ...     open(os.path.join(d, name), "w").close()
+    >>> [os.path.relpath(f, d) for f in iter_files(d)]
+    ['a-c', 'a/b', 'a/d/e', 'a0']
+    >>> files = glob.glob(f"{d}/**", recursive=True)
+    >>> list(iter_files(d)) == [f for f in sorted(files) if os.path.isfile(f)]
+    True
+    >>> # matches of the pattern itself are sorted first, then each one is walked
+    >>> [os.path.relpath(f, d) for f in iter_files(os.path.join(d, "a*"))]
+    ['a/b', 'a/d/e', 'a-c', 'a0']
+    >>> import shutil; shutil.rmtree(d)
+    """
+    for path in sorted(glob.iglob(pattern)):
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            continue
+        if stat.S_ISDIR(mode):
+            yield from _walk(path)
+        elif stat.S_ISREG(mode):
+            yield path
+
+
+def _walk(top):
+    try:
+        with os.scandir(top) as it:
+            entries = [entry for entry in it if not entry.name.startswith(".")]
+    except OSError:
+        return
+    # Sort directories as if their names end with "/", so walking them depth-first
+    # yields the same order as sorting full paths. DirEntry caches the file type
+    # from readdir, so neither this nor the checks below stat again.
+    entries.sort(key=lambda entry: entry.name + "/" if entry.is_dir() else entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from _walk(entry.path)
+        elif entry.is_file():
+            yield entry.path
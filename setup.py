@@ -5,7 +5,10 @@ from setuptools import find_packages, setup
 version = "0.0.1"
 
 install_requires = [
+    "blake3",
+    "docker",
     "dockerfile-parse==0.0.16",
+    "pathspec>=0.9",
     "requests",
 ]
 